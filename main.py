@@ -12,19 +12,46 @@ Author: Praveen
 Project: Conversational IVR Modernization
 """
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from pydantic import BaseModel
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List
+from dataclasses import dataclass, field
+from types import MappingProxyType
+from cachetools import TTLCache
 import uuid
-import json
+import orjson
+import time
+import queue
+import logging
+from logging.handlers import QueueHandler, QueueListener
 from datetime import datetime
 import sys
 import os
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 from utils.flow_manager import FlowManager
 
-app = FastAPI(title="Train IVR System", version="1.0.0")
+def _setup_logging() -> None:
+    """Hand log records to a background thread via a queue so formatting and
+    stdout writes never block the event loop"""
+    root = logging.getLogger()
+    if any(isinstance(h, QueueHandler) for h in root.handlers):
+        return  # Already configured (module imported more than once)
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    root.setLevel(logging.INFO)
+    root.addHandler(QueueHandler(log_queue))
+    QueueListener(log_queue, logging.StreamHandler()).start()
+
+
+_setup_logging()
+logger = logging.getLogger(__name__)
+
+# Call logs directory - created once at startup instead of probing per call
+_LOG_DIR = "backend/logs"
+os.makedirs(_LOG_DIR, exist_ok=True)
+
+app = FastAPI(title="Train IVR System", version="1.0.0", default_response_class=ORJSONResponse)
 
 # Enable CORS for frontend integration
 app.add_middleware(
@@ -35,15 +62,80 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# In-memory session storage
-sessions: Dict[str, Dict[str, Any]] = {}
-# Initialize flow manager - will auto-load all flows
+@dataclass(slots=True)
+class Session:
+    """Per-call session record - slotted so hot-path access is by fixed offset,
+    not dict hashing, and per-session memory stays small"""
+    session_id: str
+    started_at: str
+    started_monotonic: float
+    current_flow: str = "train_main"
+    current_state: str = "main_menu"
+    history: List[Dict[str, str]] = field(default_factory=list)
+    user_turn_count: int = 0
+    data: Dict[str, Any] = field(default_factory=dict)  # Train number, PNR, etc.
+    ended_at: Optional[str] = None
+
+    # Dict-style access kept for FlowManager, which received a plain dict
+    # under the original contract (session["data"], session["current_state"])
+    def __getitem__(self, key: str) -> Any:
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        try:
+            setattr(self, key, value)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def __contains__(self, key: str) -> bool:
+        return hasattr(self, key)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return getattr(self, key, default)
+
+
+# In-memory session storage - bounded with a TTL so abandoned calls
+# (crashed clients, never-ended sessions) are evicted instead of leaking
+sessions: TTLCache = TTLCache(maxsize=100_000, ttl=3600)
+
+
+def _touch(session_id: str) -> None:
+    """Refresh a session's TTL by re-inserting it into the cache"""
+    session = sessions.get(session_id)
+    if session is not None:
+        sessions[session_id] = session
+# Initialize flow manager - loads and caches all flows once at startup
 flow_manager = FlowManager()
 
-# Force reload flows on startup to ensure latest changes
-def reload_flows():
-    """Force reload flows from disk"""
-    flow_manager.reload_flows()
+# Memoized lookups over the static flow JSON - populated lazily, cleared on reload
+_flow_cache: Dict[str, Dict[str, Any]] = {}
+_state_cache: Dict[tuple, Dict[str, Any]] = {}
+
+
+def _get_flow(flow_name: str) -> Dict[str, Any]:
+    """Fetch a flow by name, caching the result (flows are static after load)"""
+    flow = _flow_cache.get(flow_name)
+    if flow is None:
+        flow = flow_manager.get_flow(flow_name)
+        _flow_cache[flow_name] = flow
+    return flow
+
+
+def _get_state(flow_name: str, state_name: str) -> Dict[str, Any]:
+    """Fetch a single state dict via a flat (flow, state) key, caching the result"""
+    key = (flow_name, state_name)
+    state = _state_cache.get(key)
+    if state is None:
+        state = _get_flow(flow_name).get("states", {}).get(state_name, {})
+        if "options" in state:
+            # Freeze options so every handler shares one mapping per state
+            # instead of allocating fresh dicts
+            state = {**state, "options": MappingProxyType(state["options"])}
+        _state_cache[key] = state
+    return state
 
 
 # Pydantic models for request/response
@@ -68,17 +160,53 @@ class IVRResponse(BaseModel):
     is_end: bool = False
 
 
-def get_greeting() -> str:
-    """Return time-based greeting"""
-    hour = datetime.now().hour
-    if 5 <= hour < 12:
-        return "Good morning"
-    elif 12 <= hour < 17:
-        return "Good afternoon"
-    elif 17 <= hour < 21:
-        return "Good evening"
-    else:
-        return "Good night"
+# Static message/menu content - built once at import instead of per request
+_WELCOME_TEMPLATE = (
+    "{greeting}! Thank you for calling the Train Enquiry System. My name is "
+    "your virtual assistant, and I'm here to help you with all your "
+    "train-related queries today. "
+)
+_FALLBACK_MENU_TEXT = (
+    "Press 1 for Booking, Press 2 for Train Status, Press 3 for Schedule, "
+    "Press 4 for Cancellation, Press 5 for PNR Status, Press 6 for Seat "
+    "Availability, Press 7 for Fare Enquiry, Press 8 for Trains Between "
+    "Stations, Press 0 to Repeat Menu, Press Star for Main Menu, or Press 9 "
+    "for Customer Support. You can also speak your request anytime. "
+    "How can I help you today?"
+)
+_FALLBACK_MENU_OPTIONS = MappingProxyType({
+    "1": "Book Train Ticket",
+    "2": "Check Train Status",
+    "3": "Train Schedule",
+    "4": "Ticket Cancellation",
+    "5": "PNR Status Check",
+    "6": "Seat Availability",
+    "7": "Fare Enquiry",
+    "8": "Trains Between Stations",
+    "0": "Repeat Menu",
+    "*": "Return to Main Menu",
+    "#": "Confirm/Submit",
+    "9": "Talk to Customer Support Agent"
+})
+_EMPTY_OPTIONS: Dict[str, str] = MappingProxyType({})
+_KEYPAD_CHARS = frozenset("0123456789*#")
+# 128-entry ASCII table: 1 where the character is a valid keypad key, so
+# classification is a single indexed read instead of a set probe
+_IS_KEYPAD = bytes(1 if chr(i) in _KEYPAD_CHARS else 0 for i in range(128))
+
+# Hour-of-day (0-23) -> greeting, indexed directly instead of a compare chain
+_GREETINGS = (
+    ("Good night",) * 5
+    + ("Good morning",) * 7
+    + ("Good afternoon",) * 5
+    + ("Good evening",) * 4
+    + ("Good night",) * 3
+)
+
+
+def get_greeting(hour: Optional[int] = None) -> str:
+    """Return time-based greeting (pass the current hour to avoid an extra datetime.now())"""
+    return _GREETINGS[hour if hour is not None else datetime.now().hour]
 
 
 @app.get("/")
@@ -99,61 +227,41 @@ async def root():
 @app.post("/api/ivr/start", response_model=IVRResponse)
 async def start_ivr(request: IVRStartRequest = None):
     """Initialize a new IVR session and return welcome message + main menu"""
-    session_id = str(uuid.uuid4())
-    greeting = get_greeting()
-    
+    session_id = uuid.uuid4().hex
+    now = datetime.now()
+    now_iso = now.isoformat()
+    greeting = get_greeting(now.hour)
+
     # Initialize session
-    sessions[session_id] = {
-        "session_id": session_id,
-        "started_at": datetime.now().isoformat(),
-        "current_flow": "train_main",
-        "current_state": "main_menu",
-        "history": [],
-        "data": {}  # Store user inputs like train number, PNR, etc.
-    }
-    
-    # Reload flows to ensure latest changes are loaded
-    flow_manager.reload_flows()
+    session = Session(
+        session_id=session_id,
+        started_at=now_iso,
+        started_monotonic=time.monotonic()
+    )
+    sessions[session_id] = session
     
-    # Get main menu flow
-    main_flow = flow_manager.get_flow("train_main")
-    main_menu = main_flow.get("states", {}).get("main_menu", {})
+    # Get main menu state (cached flat lookup instead of re-descending nested dicts)
+    main_menu = _get_state("train_main", "main_menu")
     
     # More conversational welcome message with complete information
-    welcome_message = f"{greeting}! Thank you for calling the Train Enquiry System. My name is your virtual assistant, and I'm here to help you with all your train-related queries today. "
+    welcome_message = _WELCOME_TEMPLATE.format(greeting=greeting)
     menu_message = main_menu.get("message", "")
-    
-    # Use the message from flow file, or construct complete one
-    if menu_message:
-        full_message = welcome_message + menu_message
-    else:
-        full_message = welcome_message + "Press 1 for Booking, Press 2 for Train Status, Press 3 for Schedule, Press 4 for Cancellation, Press 5 for PNR Status, Press 6 for Seat Availability, Press 7 for Fare Enquiry, Press 8 for Trains Between Stations, Press 0 to Repeat Menu, Press Star for Main Menu, or Press 9 for Customer Support. You can also speak your request anytime. How can I help you today?"
+
+    # Use the message from flow file, or fall back to the precomputed menu text
+    full_message = welcome_message + (menu_message or _FALLBACK_MENU_TEXT)
     
     # Log to session
-    sessions[session_id]["history"].append({
+    session.history.append({
         "type": "system",
         "message": full_message,
-        "timestamp": datetime.now().isoformat()
+        "timestamp": now_iso
     })
     
     # Ensure all options are included
-    menu_options = main_menu.get("options", {})
+    menu_options = main_menu.get("options", _EMPTY_OPTIONS)
     if not menu_options or len(menu_options) < 10:
         # Fallback options if not loaded correctly
-        menu_options = {
-            "1": "Book Train Ticket",
-            "2": "Check Train Status",
-            "3": "Train Schedule",
-            "4": "Ticket Cancellation",
-            "5": "PNR Status Check",
-            "6": "Seat Availability",
-            "7": "Fare Enquiry",
-            "8": "Trains Between Stations",
-            "0": "Repeat Menu",
-            "*": "Return to Main Menu",
-            "#": "Confirm/Submit",
-            "9": "Talk to Customer Support Agent"
-        }
+        menu_options = _FALLBACK_MENU_OPTIONS
     
     return IVRResponse(
         session_id=session_id,
@@ -168,25 +276,38 @@ async def start_ivr(request: IVRStartRequest = None):
 async def process_input(request: IVRInputRequest):
     """Process user input (keypad key or speech) and return IVR response"""
     
-    if request.session_id not in sessions:
+    session = sessions.get(request.session_id)
+    if session is None:
         raise HTTPException(status_code=404, detail="Session not found")
-    
-    session = sessions[request.session_id]
-    user_input = request.input.strip().lower()
-    
-    # Log user input
-    session["history"].append({
+
+    # Keypad keys - the common IVR input - need no normalization, so skip the
+    # strip()/lower() string allocations for them and classify on the spot
+    raw_input = request.input
+    if len(raw_input) == 1 and raw_input in _KEYPAD_CHARS:
+        user_input = raw_input
+        is_keypad = True
+    else:
+        user_input = raw_input.strip().lower()
+        if len(user_input) == 1:
+            code = ord(user_input)
+            is_keypad = code < 128 and _IS_KEYPAD[code] == 1
+        else:
+            is_keypad = False
+
+    now_iso = datetime.now().isoformat()
+
+    # User entry is logged together with the system response below, in a
+    # single history.extend() at the end of the exchange
+    user_entry = {
         "type": "user",
         "message": user_input,
-        "timestamp": datetime.now().isoformat()
-    })
-    
-    current_flow_name = session["current_flow"]
-    current_state = session["current_state"]
-    current_flow = flow_manager.get_flow(current_flow_name)
-    
-    # Determine if input is keypad (single digit/key) or speech
-    is_keypad = len(user_input) == 1 and user_input in "0123456789*#"
+        "timestamp": now_iso
+    }
+    session.user_turn_count += 1
+
+    current_flow_name = session.current_flow
+    current_state = session.current_state
+    current_flow = _get_flow(current_flow_name)
     
     # Process input with error handling
     try:
@@ -197,30 +318,30 @@ async def process_input(request: IVRInputRequest):
             is_keypad,
             session
         )
-    except Exception as e:
+    except Exception:
         # Graceful error handling - never get stuck
-        print(f"Error processing input: {e}")
+        logger.exception("process_input failed", extra={"session_id": request.session_id})
         response_message = "I apologize, but I encountered an issue processing your request. Let's try again! You can say your request again or use the keypad. How can I help you?"
         next_state = current_state if current_state else "main_menu"
-        options = {}
+        options = _EMPTY_OPTIONS
         is_end = False
     
     # Update session
-    session["current_state"] = next_state
-    
-    # Check if we need to switch flows
-    if next_state.startswith("flow:"):
-        # Extract flow name from state (e.g., "flow:booking" -> "booking")
-        new_flow_name = next_state.split(":")[1]
-        session["current_flow"] = new_flow_name
-        new_flow = flow_manager.get_flow(new_flow_name)
+    session.current_state = next_state
+
+    # Check if we need to switch flows (e.g., "flow:booking" -> "booking") -
+    # a single partition() parses the prefix and target flow in one pass
+    state_prefix, _, new_flow_name = next_state.partition(":")
+    if state_prefix == "flow" and new_flow_name:
+        session.current_flow = new_flow_name
+        new_flow = _get_flow(new_flow_name)
         initial_state_name = new_flow.get("initial_state", "main_menu")
-        session["current_state"] = initial_state_name
-        
+        session.current_state = initial_state_name
+
         # Get the new state's message immediately - show the first question
-        new_state_data = new_flow.get("states", {}).get(initial_state_name, {})
+        new_state_data = _get_state(new_flow_name, initial_state_name)
         response_message = new_state_data.get("message", "How can I help you?")
-        options = new_state_data.get("options", {})
+        options = new_state_data.get("options", _EMPTY_OPTIONS)
         next_state = initial_state_name
         
         # If the state has collect_data, ask the question immediately
@@ -228,13 +349,19 @@ async def process_input(request: IVRInputRequest):
             # Message already set above, just ensure it's displayed
             pass
     
-    # Log system response
-    session["history"].append({
-        "type": "system",
-        "message": response_message,
-        "timestamp": datetime.now().isoformat()
-    })
-    
+    # Log both sides of the exchange in one batch
+    session.history.extend((
+        user_entry,
+        {
+            "type": "system",
+            "message": response_message,
+            "timestamp": now_iso
+        }
+    ))
+
+    # Keep active sessions alive in the TTL cache
+    _touch(request.session_id)
+
     return IVRResponse(
         session_id=request.session_id,
         message=response_message,
@@ -244,48 +371,69 @@ async def process_input(request: IVRInputRequest):
     )
 
 
+def _write_call_log(session_id: str, summary: Dict[str, Any]) -> None:
+    """Write the call summary to disk (runs as a background task, off the event loop)"""
+    try:
+        with open(os.path.join(_LOG_DIR, f"call_{session_id}.json"), "wb") as f:
+            f.write(orjson.dumps(summary, option=orjson.OPT_INDENT_2))
+    except OSError as e:
+        logger.warning("Failed to write call log for session %s: %s", session_id, e)
+
+
 @app.post("/api/ivr/end")
-async def end_ivr(request: IVREndRequest):
+async def end_ivr(request: IVREndRequest, background_tasks: BackgroundTasks):
     """End IVR session and return call summary"""
     
-    if request.session_id not in sessions:
+    session = sessions.get(request.session_id)
+    if session is None:
         raise HTTPException(status_code=404, detail="Session not found")
-    
-    session = sessions[request.session_id]
-    session["ended_at"] = datetime.now().isoformat()
-    
-    # Calculate call duration
-    started = datetime.fromisoformat(session["started_at"])
-    ended = datetime.fromisoformat(session["ended_at"])
-    duration = (ended - started).total_seconds()
-    
+
+    session.ended_at = datetime.now().isoformat()
+
+    # Calculate call duration from the monotonic clock - no ISO string
+    # re-parsing, and immune to wall-clock adjustments
+    duration = time.monotonic() - session.started_monotonic
+
     # Create summary
     summary = {
         "session_id": request.session_id,
         "duration_seconds": round(duration, 2),
-        "started_at": session["started_at"],
-        "ended_at": session["ended_at"],
-        "total_exchanges": len([h for h in session["history"] if h["type"] == "user"]),
-        "transcript": session["history"],
-        "collected_data": session["data"]
+        "started_at": session.started_at,
+        "ended_at": session.ended_at,
+        "total_exchanges": session.user_turn_count,
+        "transcript": session.history,
+        "collected_data": session.data
     }
     
-    # Optionally save to file (for production, use database)
-    try:
-        with open(f"backend/logs/call_{request.session_id}.json", "w") as f:
-            json.dump(summary, f, indent=2)
-    except:
-        pass  # Logs directory might not exist
-    
-    # Keep session for a while (optional cleanup later)
-    # del sessions[request.session_id]  # Uncomment to remove immediately
-    
+    # Optionally save to file (for production, use database) - done after the
+    # response is sent so disk I/O never blocks the event loop
+    background_tasks.add_task(_write_call_log, request.session_id, summary)
+
+    # The client already saw every message, so the response carries a pointer
+    # to the transcript instead of re-serializing the full history inline.
+    # The session is left in the TTL cache so the URL stays valid until expiry.
     return {
         "message": "Call ended successfully",
-        "summary": summary
+        "summary": {
+            "session_id": request.session_id,
+            "duration_seconds": summary["duration_seconds"],
+            "started_at": summary["started_at"],
+            "ended_at": summary["ended_at"],
+            "total_exchanges": summary["total_exchanges"],
+            "transcript_url": f"/api/session/{request.session_id}/transcript"
+        }
     }
 
 
+@app.post("/api/admin/reload_flows")
+async def reload_flows():
+    """Force reload flows from disk (dev use only - flows are cached at startup)"""
+    flow_manager.reload_flows()
+    _flow_cache.clear()
+    _state_cache.clear()
+    return {"message": "Flows reloaded successfully"}
+
+
 @app.get("/api/flows")
 async def get_flows():
     """Return list of available flows and their structure"""
@@ -293,7 +441,7 @@ async def get_flows():
     flow_names = ["train_main", "booking", "status", "schedule", "cancellation"]
     
     for flow_name in flow_names:
-        flow = flow_manager.get_flow(flow_name)
+        flow = _get_flow(flow_name)
         flows_info[flow_name] = {
             "name": flow.get("name", flow_name),
             "description": flow.get("description", ""),
@@ -307,15 +455,43 @@ async def get_flows():
     }
 
 
+@app.get("/api/session/{session_id}/transcript")
+async def get_transcript(session_id: str):
+    """Stream a session's transcript as newline-delimited JSON"""
+    session = sessions.get(session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Session not found")
+    history = session.history
+
+    def _entries():
+        for entry in history:
+            yield orjson.dumps(entry) + b"\n"
+
+    return StreamingResponse(_entries(), media_type="application/x-ndjson")
+
+
 @app.get("/api/session/{session_id}")
 async def get_session(session_id: str):
     """Get session details (for debugging)"""
-    if session_id not in sessions:
+    session = sessions.get(session_id)
+    if session is None:
         raise HTTPException(status_code=404, detail="Session not found")
-    return sessions[session_id]
+    return session
 
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # uvloop + httptools cut event-loop and HTTP-parsing overhead. Workers
+    # stay at 1 because sessions live in process memory; scaling out needs a
+    # shared session store (e.g. Redis) first. The app object is passed
+    # directly - the "main:app" import string would re-execute this module
+    # (second FlowManager, duplicate logging) and is only needed for workers>1.
+    uvicorn.run(
+        app,
+        host="0.0.0.0",
+        port=8000,
+        loop="uvloop",
+        http="httptools",
+        access_log=False
+    )
 